@@ -0,0 +1,687 @@
+"""Shared models and persistence for the knowledge graph server.
+
+Everything below is entrypoint-agnostic: the Pydantic models, the append-only
+JSONL log (or SQLite backend), the graph cache, the background writer and the
+transaction context manager. main.py holds only the FastAPI app and route
+handlers, so alternative entrypoints can reuse this module without copying it.
+"""
+
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import List, Optional
+from contextlib import asynccontextmanager
+from pathlib import Path
+import asyncio
+import mmap
+import orjson
+import os
+import threading
+
+# --- Persistence Path ---
+MEMORY_FILE_PATH_ENV = os.getenv("MEMORY_FILE_PATH", "memory.json")
+MEMORY_FILE_PATH = Path(
+    MEMORY_FILE_PATH_ENV if Path(MEMORY_FILE_PATH_ENV).is_absolute() else Path(__file__).parent / MEMORY_FILE_PATH_ENV
+)
+
+# "strict": every commit is fsync'd and the request waits for it to hit disk.
+# "loose" (default): commits are handed to the background writer and the
+# request returns as soon as the in-memory graph is updated.
+MEMORY_DURABILITY = os.getenv("MEMORY_DURABILITY", "loose")
+
+# Storage backend: "jsonl" (default) keeps the append-only log; "sqlite"
+# stores the graph in a WAL-mode SQLite database with an FTS5 search index.
+# Both consume the same record stream, so endpoint logic is backend-agnostic.
+MEMORY_BACKEND = os.getenv("MEMORY_BACKEND", "jsonl")
+if MEMORY_BACKEND == "sqlite":
+    import sqlite_store
+    DB_PATH = MEMORY_FILE_PATH if MEMORY_FILE_PATH.suffix == ".db" else MEMORY_FILE_PATH.with_suffix(".db")
+    sqlite_store.init(DB_PATH, strict=MEMORY_DURABILITY == "strict")
+
+# Optional persistent full-text index for the JSONL backend
+# (MEMORY_SEARCH_INDEX=fts5): an FTS5 sidecar database mirrors entity text,
+# so search survives restarts without rebuilding the in-memory trigram index.
+_fts_index = None
+if MEMORY_BACKEND == "jsonl" and os.getenv("MEMORY_SEARCH_INDEX") == "fts5":
+    import sqlite_store
+    _fts_index = sqlite_store.FtsIndex(MEMORY_FILE_PATH.with_suffix(".search.db"))
+
+# --- Models ---
+class Entity(BaseModel):
+    name: str
+    entityType: str
+    observations: List[str]
+    created_at: Optional[str] = None
+    updated_at: Optional[str] = None
+    source: Optional[str] = None
+    user_id: Optional[str] = None
+    tags: Optional[List[str]] = []
+
+    # Parallel set over observations so dedup checks are O(1) instead of
+    # scanning the list; the list keeps insertion order for serialization.
+    _obs_set: set = PrivateAttr(default_factory=set)
+
+    def model_post_init(self, __context):
+        self._obs_set = set(self.observations)
+
+    def add_new_observations(self, contents: List[str]) -> List[str]:
+        added = [c for c in contents if c not in self._obs_set]
+        self._obs_set.update(added)
+        self.observations.extend(added)
+        return added
+
+    def remove_observations(self, contents: List[str]):
+        remove = set(contents)
+        self._obs_set.difference_update(remove)
+        self.observations = [o for o in self.observations if o not in remove]
+
+class Relation(BaseModel):
+    from_: str = Field(..., alias="from")
+    to: str
+    relationType: str
+
+class KnowledgeGraph(BaseModel):
+    entities: List[Entity]
+    relations: List[Relation]
+
+    # O(1) lookup indices over the lists above. All mutations must go through
+    # the helper methods below so lists and indices stay in sync; the lists
+    # remain the response-serialization view.
+    _entities_by_name: dict = PrivateAttr(default_factory=dict)
+    _relations_index: set = PrivateAttr(default_factory=set)
+    _relations_by_from: dict = PrivateAttr(default_factory=dict)
+    _relations_by_to: dict = PrivateAttr(default_factory=dict)
+    # One lower-cased newline-joined blob of (name, entityType, observations)
+    # per entity, so a match is a single C-level substring scan rather than a
+    # Python loop over fields. The trigram index is built lazily on the first
+    # search and only ever grows: stale candidates are filtered out by the
+    # exact substring check, so deletions need no upkeep.
+    _search_text: dict = PrivateAttr(default_factory=dict)
+    _trigram_index: Optional[dict] = PrivateAttr(default=None)
+    # Guards the lazy trigram build: sync endpoints run in the threadpool, so
+    # two searches can race the first build, and event-loop mutations must not
+    # insert into an index that is still being constructed.
+    _trigram_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    # Equality indices (value -> entity names) so selective user_id/source/tag
+    # filters can shrink the candidate set before any substring work runs.
+    _by_user_id: dict = PrivateAttr(default_factory=dict)
+    _by_source: dict = PrivateAttr(default_factory=dict)
+    _by_tag: dict = PrivateAttr(default_factory=dict)
+
+    def model_post_init(self, __context):
+        self._entities_by_name = {e.name: e for e in self.entities}
+        self._search_text = {e.name: self._entity_text(e) for e in self.entities}
+        self._trigram_index = None
+        self._trigram_lock = threading.Lock()
+        self._by_user_id = {}
+        self._by_source = {}
+        self._by_tag = {}
+        for e in self.entities:
+            self._index_entity_attrs(e)
+        self._reindex_relations()
+
+    def _index_entity_attrs(self, entity: "Entity"):
+        if entity.user_id:
+            self._by_user_id.setdefault(entity.user_id, set()).add(entity.name)
+        if entity.source:
+            self._by_source.setdefault(entity.source, set()).add(entity.name)
+        for tag in entity.tags or []:
+            self._by_tag.setdefault(tag, set()).add(entity.name)
+
+    def _unindex_entity_attrs(self, entity: "Entity"):
+        if entity.user_id:
+            self._by_user_id.get(entity.user_id, set()).discard(entity.name)
+        if entity.source:
+            self._by_source.get(entity.source, set()).discard(entity.name)
+        for tag in entity.tags or []:
+            self._by_tag.get(tag, set()).discard(entity.name)
+
+    def _reindex_relations(self):
+        self._relations_index = {(r.from_, r.to, r.relationType) for r in self.relations}
+        self._relations_by_from = {}
+        self._relations_by_to = {}
+        for r in self.relations:
+            self._relations_by_from.setdefault(r.from_, []).append(r)
+            self._relations_by_to.setdefault(r.to, []).append(r)
+
+    @staticmethod
+    def _entity_text(entity: "Entity") -> str:
+        # Fields are joined with newlines; queries that themselves contain a
+        # newline are matched per field in _matches, so a blob match can
+        # never bridge two fields.
+        return "\n".join((entity.name, entity.entityType or "", *entity.observations)).lower()
+
+    @staticmethod
+    def _index_trigrams(index: dict, name: str, text: str):
+        for i in range(len(text) - 2):
+            index.setdefault(text[i:i + 3], set()).add(name)
+
+    def reindex_entity(self, entity: "Entity"):
+        """Refresh the cached search text after an entity's fields changed."""
+        text = self._entity_text(entity)
+        self._search_text[entity.name] = text
+        # Taken so an in-progress lazy build can't miss this entity: the
+        # insert waits until the built index has been published.
+        with self._trigram_lock:
+            if self._trigram_index is not None:
+                self._index_trigrams(self._trigram_index, entity.name, text)
+
+    def _matches(self, q: str, name: str) -> bool:
+        text = self._search_text.get(name)
+        if text is None:
+            return False
+        if "\n" in q:
+            # The blob's field separator is a newline, so a query containing
+            # one could match across field boundaries; fall back to comparing
+            # against each field individually.
+            entity = self.get_entity(name)
+            return entity is not None and any(
+                q in field.lower()
+                for field in (entity.name, entity.entityType or "", *entity.observations)
+            )
+        return q in text
+
+    def search_entities(self, query: str, user_id: Optional[str] = None,
+                        source: Optional[str] = None, tags: Optional[List[str]] = None) -> List[Entity]:
+        # Cheapest predicates first: equality filters narrow the candidate set
+        # before any substring matching happens.
+        allowed = None
+        for index, value in ((self._by_user_id, user_id), (self._by_source, source)):
+            if value is not None:
+                names = index.get(value, set())
+                allowed = names.copy() if allowed is None else allowed & names
+        for tag in tags or []:
+            names = self._by_tag.get(tag, set())
+            allowed = names.copy() if allowed is None else allowed & names
+        if allowed is not None and not allowed:
+            return []
+        q = query.lower()
+        if len(q) >= 3:
+            if self._trigram_index is None:
+                # Build into a local dict and publish with one assignment so
+                # concurrent searches never observe a partial index; list()
+                # snapshots the items atomically under the GIL, so mutations
+                # on the event loop can't break the iteration.
+                with self._trigram_lock:
+                    if self._trigram_index is None:
+                        index = {}
+                        for name, text in list(self._search_text.items()):
+                            self._index_trigrams(index, name, text)
+                        self._trigram_index = index
+            candidates = None
+            for i in range(len(q) - 2):
+                names = self._trigram_index.get(q[i:i + 3])
+                if not names:
+                    return []
+                candidates = names.copy() if candidates is None else candidates & names
+            if allowed is not None:
+                candidates &= allowed
+            return [
+                e for e in (self.get_entity(name) for name in candidates)
+                if e is not None and self._matches(q, e.name)
+            ]
+        if allowed is not None:
+            return [
+                e for e in (self.get_entity(name) for name in allowed)
+                if e is not None and self._matches(q, e.name)
+            ]
+        return [e for e in self.entities if self._matches(q, e.name)]
+
+    def get_entity(self, name: str) -> Optional[Entity]:
+        return self._entities_by_name.get(name)
+
+    def has_relation(self, key: tuple) -> bool:
+        return key in self._relations_index
+
+    def relations_between(self, names: set) -> List[Relation]:
+        """Relations with both endpoints in names, via adjacency lookup.
+
+        O(len(names) x avg out-degree) instead of a scan over all relations.
+        """
+        return [r for name in names for r in self._relations_by_from.get(name, []) if r.to in names]
+
+    def add_entity(self, entity: "Entity"):
+        self.entities.append(entity)
+        self._entities_by_name[entity.name] = entity
+        self._index_entity_attrs(entity)
+        self.reindex_entity(entity)
+
+    def add_relation(self, relation: "Relation"):
+        self.relations.append(relation)
+        self._relations_index.add((relation.from_, relation.to, relation.relationType))
+        self._relations_by_from.setdefault(relation.from_, []).append(relation)
+        self._relations_by_to.setdefault(relation.to, []).append(relation)
+
+    def _purge_adjacency(self, relation: "Relation", keys: set, skip: set):
+        """Drop relations matching keys from the adjacency lists of surviving endpoints."""
+        for adj, endpoint in ((self._relations_by_from, relation.from_), (self._relations_by_to, relation.to)):
+            if endpoint in skip:
+                continue
+            lst = adj.get(endpoint)
+            if lst is not None:
+                lst[:] = [r for r in lst if (r.from_, r.to, r.relationType) not in keys]
+                if not lst:
+                    del adj[endpoint]
+
+    def remove_entities(self, names: set):
+        if not names:
+            return
+        self.entities = [e for e in self.entities if e.name not in names]
+        doomed = []
+        for name in names:
+            entity = self._entities_by_name.pop(name, None)
+            if entity is not None:
+                self._unindex_entity_attrs(entity)
+            self._search_text.pop(name, None)
+            doomed.extend(self._relations_by_from.pop(name, []))
+            doomed.extend(self._relations_by_to.pop(name, []))
+        if doomed:
+            keys = {(r.from_, r.to, r.relationType) for r in doomed}
+            self._relations_index.difference_update(keys)
+            self.relations = [r for r in self.relations if (r.from_, r.to, r.relationType) not in keys]
+            for r in doomed:
+                self._purge_adjacency(r, keys, names)
+
+    def remove_relations(self, keys: set):
+        if not keys:
+            return
+        removed = [r for r in self.relations if (r.from_, r.to, r.relationType) in keys]
+        self.relations = [r for r in self.relations if (r.from_, r.to, r.relationType) not in keys]
+        self._relations_index.difference_update(keys)
+        for r in removed:
+            self._purge_adjacency(r, keys, set())
+
+class ObservationItem(BaseModel):
+    entityName: str
+    contents: List[str]
+
+class AddObservationsRequest(BaseModel):
+    observations: List[ObservationItem]
+
+class CreateEntitiesRequest(BaseModel):
+    entities: List[Entity]
+
+class CreateRelationsRequest(BaseModel):
+    relations: List[Relation]
+
+class DeleteEntitiesRequest(BaseModel):
+    entityNames: List[str]
+
+class DeleteRelationsRequest(BaseModel):
+    relations: List[Relation]
+
+class DeletionItem(BaseModel):
+    entityName: str
+    observations: List[str]
+
+class DeleteObservationsRequest(BaseModel):
+    deletions: List[DeletionItem]
+
+class SearchNodesRequest(BaseModel):
+    query: str
+    user_id: Optional[str] = None
+    source: Optional[str] = None
+    tags: Optional[List[str]] = None
+
+class OpenNodesRequest(BaseModel):
+    names: List[str]
+
+# --- Append log state ---
+# Mutations are appended to the JSONL log instead of rewriting the whole file;
+# deletions append tombstone records which are applied on replay. The log is
+# compacted once tombstones make up more than COMPACT_TOMBSTONE_RATIO of it.
+COMPACT_TOMBSTONE_RATIO = 0.3
+
+_log_lock = threading.Lock()
+_log_fd = None
+_log_records = 0
+_log_tombstones = 0
+
+def _log_handle() -> int:
+    global _log_fd
+    if _log_fd is None:
+        fd = os.open(MEMORY_FILE_PATH, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        size = os.fstat(fd).st_size
+        if size and os.pread(fd, 1, size - 1) != b"\n":
+            # Files written by older full-rewrite versions lack a trailing newline.
+            os.write(fd, b"\n")
+        _log_fd = fd
+    return _log_fd
+
+def append_records(records: list):
+    global _log_records, _log_tombstones
+    if not records:
+        return
+    if MEMORY_BACKEND == "sqlite":
+        sqlite_store.apply_records(records)
+        return
+    payload = b"".join(orjson.dumps(r) + b"\n" for r in records)
+    with _log_lock:
+        fd = _log_handle()
+        os.write(fd, payload)
+        if MEMORY_DURABILITY == "strict":
+            os.fsync(fd)
+        _log_records += len(records)
+        _log_tombstones += sum(1 for r in records if r["type"].startswith("tombstone_"))
+    _sync_search_index(records)
+    # Checked here, after the counters reflect this batch, rather than from a
+    # response background task that would race the group-commit window and
+    # read stale counters. Runs on the writer thread, off the event loop.
+    maybe_compact()
+
+def _sync_search_index(records: list):
+    """Mirror a committed batch into the FTS sidecar, if one is enabled."""
+    if _fts_index is None:
+        return
+    graph = _GRAPH_CACHE[1] if _GRAPH_CACHE is not None else None
+    for record in records:
+        kind = record["type"]
+        if kind == "tombstone_entity":
+            _fts_index.delete(record["name"])
+        elif kind in ("entity", "observation", "tombstone_observations"):
+            name = record.get("name") or record["entityName"]
+            entity = graph.get_entity(name) if graph is not None else None
+            if entity is not None:
+                _fts_index.update(name, entity.entityType, entity.observations)
+            else:
+                _fts_index.delete(name)
+    _fts_index.set_stamp(repr(_stat_key()))
+
+def append_record(record: dict):
+    append_records([record])
+
+# --- Background writer ---
+# Mutating requests enqueue their staged records instead of writing on the
+# request path; a single writer task drains the queue and performs the
+# append (plus fsync in strict mode) off the event loop. In strict mode the
+# request additionally awaits the commit future before responding.
+#
+# Bursty workloads are group-committed: after the first batch arrives the
+# writer keeps collecting batches for a short debounce window and flushes
+# them all with one write()/fsync, so N concurrent mutations cost one commit.
+GROUP_COMMIT_WINDOW = float(os.getenv("MEMORY_GROUP_COMMIT_MS", "50")) / 1000.0
+
+_write_queue = asyncio.Queue()
+_writer_task = None
+# Commits enqueued but not yet applied by the writer. While non-zero, the
+# FTS indexes lag the in-memory graph, so search must not consult them.
+_commits_in_flight = 0
+
+async def _writer_loop():
+    global _commits_in_flight
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _write_queue.get()]
+        deadline = loop.time() + GROUP_COMMIT_WINDOW
+        while True:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_write_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        records = [r for item in batch for r in item[0]]
+        graph = batch[-1][1]
+        try:
+            await asyncio.to_thread(append_records, records)
+            _refresh_cache(graph)
+            for _, _, done in batch:
+                if done is not None and not done.done():
+                    done.set_result(None)
+        except Exception as exc:
+            for _, _, done in batch:
+                if done is not None and not done.done():
+                    done.set_exception(exc)
+        finally:
+            _commits_in_flight -= len(batch)
+            for _ in batch:
+                _write_queue.task_done()
+
+async def start_writer():
+    """Start the background writer task; call from the app's startup hook."""
+    global _writer_task
+    _writer_task = asyncio.create_task(_writer_loop())
+
+async def stop_writer():
+    """Drain pending commits and stop the writer; call from the shutdown hook."""
+    global _writer_task
+    if _writer_task is not None:
+        await _write_queue.join()
+        _writer_task.cancel()
+        _writer_task = None
+
+# --- Graph cache ---
+# The parsed graph is cached per (mtime_ns, size) of the log file so reads
+# skip the JSONL replay entirely while the file is unchanged. Mutating
+# endpoints update the cached graph in place and refresh the key after
+# appending, so the cache stays warm across writes. Size is part of the key
+# so another worker's append (same-second mtime) still invalidates.
+_cache_lock = threading.Lock()
+_GRAPH_CACHE = None
+
+def _stat_key():
+    try:
+        st = MEMORY_FILE_PATH.stat()
+    except FileNotFoundError:
+        # Not written yet; the empty graph is cached under this key so
+        # mutations staged before the first flush are visible to later
+        # requests instead of each of them re-materializing an empty graph.
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _refresh_cache(graph: KnowledgeGraph):
+    global _GRAPH_CACHE
+    with _cache_lock:
+        _GRAPH_CACHE = (_stat_key(), graph)
+
+# --- Helpers ---
+def _apply_record(item: dict, entities: dict, relations: dict) -> bool:
+    """Apply one replayed log record in order; returns True for tombstones."""
+    kind = item.pop("type")
+    if kind == "entity":
+        if item["name"] not in entities:
+            # Records were validated when first written; skip re-validation.
+            entities[item["name"]] = Entity.model_construct(**item)
+    elif kind == "relation":
+        relations.setdefault(
+            (item["from"], item["to"], item["relationType"]),
+            Relation.model_construct(from_=item["from"], to=item["to"], relationType=item["relationType"]),
+        )
+    elif kind == "observation":
+        entity = entities.get(item["entityName"])
+        if entity:
+            entity.add_new_observations(item["contents"])
+            entity.updated_at = item.get("updated_at") or entity.updated_at
+    elif kind == "tombstone_entity":
+        entities.pop(item["name"], None)
+        for rel_key in [k for k in relations if item["name"] in (k[0], k[1])]:
+            del relations[rel_key]
+        return True
+    elif kind == "tombstone_relation":
+        relations.pop((item["from"], item["to"], item["relationType"]), None)
+        return True
+    elif kind == "tombstone_observations":
+        entity = entities.get(item["entityName"])
+        if entity:
+            entity.remove_observations(item["observations"])
+            entity.updated_at = item.get("updated_at") or entity.updated_at
+        return True
+    return False
+
+def read_graph_file() -> KnowledgeGraph:
+    global _log_records, _log_tombstones, _GRAPH_CACHE
+    key = _stat_key()
+    with _cache_lock:
+        # While commits are queued or being appended, the file on disk lags
+        # the cached graph (or, mid-append, is visible to stat before
+        # _refresh_cache runs). A stat-based miss here would replay a graph
+        # missing those mutations and publish it under a now-matching key,
+        # permanently losing them from the cache -- so trust the cached
+        # graph until the writer has caught up.
+        if _GRAPH_CACHE is not None and (_commits_in_flight or _GRAPH_CACHE[0] == key):
+            return _GRAPH_CACHE[1]
+    if MEMORY_BACKEND == "sqlite":
+        entity_dicts, relation_dicts = sqlite_store.load_graph()
+        graph = KnowledgeGraph.model_construct(
+            entities=[Entity.model_construct(**d) for d in entity_dicts],
+            relations=[
+                Relation.model_construct(from_=d["from"], to=d["to"], relationType=d["relationType"])
+                for d in relation_dicts
+            ],
+        )
+        with _cache_lock:
+            _GRAPH_CACHE = (key, graph)
+        return graph
+    if key is None:
+        graph = KnowledgeGraph.model_construct(entities=[], relations=[])
+        with _cache_lock:
+            _GRAPH_CACHE = (None, graph)
+        return graph
+    records, tombstones = 0, 0
+    entities, relations = {}, {}
+    with open(MEMORY_FILE_PATH, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size:
+            # mmap the whole log and scan for newline boundaries; each record
+            # slice goes to orjson as a zero-copy memoryview, so replay does
+            # no per-line str/bytes allocation at all.
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                view = memoryview(mm)
+                try:
+                    pos = 0
+                    while pos < size:
+                        end = mm.find(b"\n", pos)
+                        if end == -1:
+                            end = size
+                        if end > pos and mm[pos] == 0x7B:  # line starts with "{"
+                            records += 1
+                            if _apply_record(orjson.loads(view[pos:end]), entities, relations):
+                                tombstones += 1
+                        pos = end + 1
+                finally:
+                    view.release()
+    _log_records, _log_tombstones = records, tombstones
+    graph = KnowledgeGraph.model_construct(entities=list(entities.values()), relations=list(relations.values()))
+    with _cache_lock:
+        _GRAPH_CACHE = (key, graph)
+    return graph
+
+def save_graph(graph: KnowledgeGraph, path: Path = None):
+    """Write the full graph to path (default: the log file), atomically.
+
+    Records are streamed into a temp file next to the target and os.replace'd
+    over it, so readers only ever see the old file or the complete new one --
+    never a partial write. The rename also bumps the file's stat key, which is
+    what the graph cache and FTS stamp are keyed on.
+    """
+    path = path or MEMORY_FILE_PATH
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    # Stream records through a buffered writer instead of materializing the
+    # whole serialized log in memory; peak usage is one record plus the buffer.
+    with open(tmp, "wb", buffering=1 << 20) as f:
+        for e in graph.entities:
+            f.write(orjson.dumps({"type": "entity", **e.model_dump()}))
+            f.write(b"\n")
+        for r in graph.relations:
+            f.write(orjson.dumps({"type": "relation", **r.model_dump(by_alias=True)}))
+            f.write(b"\n")
+        if MEMORY_DURABILITY == "strict":
+            # Force the data down before the rename: some filesystems may
+            # otherwise commit the rename ahead of the data blocks, and a
+            # crash in between would surface an empty or truncated log.
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+    if MEMORY_DURABILITY == "strict":
+        # Persist the rename itself (the directory entry).
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+def compact_graph():
+    """Rewrite the log without tombstoned records, atomically replacing it."""
+    global _log_fd, _log_records, _log_tombstones
+    with _log_lock:
+        graph = read_graph_file()
+        save_graph(graph)  # atomic: temp file + os.replace
+        if _log_fd is not None:
+            os.close(_log_fd)
+            _log_fd = None
+        _log_records = len(graph.entities) + len(graph.relations)
+        _log_tombstones = 0
+    _refresh_cache(graph)
+    if _fts_index is not None:
+        # Content is unchanged by compaction; only the log stamp moves.
+        _fts_index.set_stamp(repr(_stat_key()))
+
+def maybe_compact():
+    if MEMORY_BACKEND != "jsonl":
+        return  # sqlite deletes rows directly; there is no log to compact
+    if _log_records and _log_tombstones / _log_records > COMPACT_TOMBSTONE_RATIO:
+        compact_graph()
+
+@asynccontextmanager
+async def graph_transaction():
+    """Load the graph once, stage mutations, and commit them in a single write.
+
+    Yields the in-memory graph and a pending-record list; endpoint bodies
+    mutate the graph through its helper methods and stage the matching log
+    records. On exit all staged records are handed to the background writer
+    in one batch, so a batch of N mutations costs one enqueue on the request
+    path. In strict durability mode the commit is awaited before returning.
+    """
+    graph = read_graph_file()
+    pending = []
+    yield graph, pending
+    if not pending:
+        _refresh_cache(graph)
+        return
+    if _writer_task is None:
+        # No writer running (e.g. scripted use outside the ASGI lifespan);
+        # fall back to a synchronous commit.
+        append_records(pending)
+        _refresh_cache(graph)
+        return
+    done = asyncio.get_running_loop().create_future() if MEMORY_DURABILITY == "strict" else None
+    global _commits_in_flight
+    _commits_in_flight += 1
+    await _write_queue.put((pending, graph, done))
+    if done is not None:
+        await done
+
+def search_graph(graph: KnowledgeGraph, query: str, user_id: Optional[str] = None,
+                 source: Optional[str] = None, tags: Optional[List[str]] = None) -> List[Entity]:
+    """Entity matches for a search query, via the best index available.
+
+    Prefers the backend's FTS5 index (SQLite backend or the sidecar for the
+    JSONL log, rebuilt lazily if its stamp is stale) and falls back to the
+    graph's in-memory search when no index can answer the query.
+    """
+    matched = None
+    # With loose durability, recent commits may still sit behind the
+    # group-commit window; the graph is current but the indexes are not,
+    # so only consult them once the writer has caught up. Queries containing
+    # a newline also skip the indexes: they store observations newline-joined
+    # and could match across field boundaries (the graph scan matches them
+    # per field).
+    if query and "\n" not in query and not _commits_in_flight:
+        if MEMORY_BACKEND == "sqlite":
+            matched = sqlite_store.search_names(query)
+        elif _fts_index is not None:
+            stamp = repr(_stat_key())
+            if _fts_index.stamp() != stamp:
+                _fts_index.rebuild(
+                    [(e.name, e.entityType, e.observations) for e in graph.entities], stamp
+                )
+            matched = _fts_index.search(query)
+    if matched is None:
+        return graph.search_entities(query, user_id=user_id, source=source, tags=tags)
+    entities = [e for e in (graph.get_entity(n) for n in matched) if e is not None]
+    if user_id is not None:
+        entities = [e for e in entities if e.user_id == user_id]
+    if source is not None:
+        entities = [e for e in entities if e.source == source]
+    for tag in tags or []:
+        entities = [e for e in entities if tag in (e.tags or [])]
+    return entities
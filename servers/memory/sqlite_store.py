@@ -0,0 +1,261 @@
+"""SQLite storage backend for the knowledge graph server.
+
+Selected with MEMORY_BACKEND=sqlite. The store consumes the same record
+stream the JSONL log uses (entity / relation / observation / tombstone_*),
+applying each commit batch inside a single transaction, so the endpoint and
+writer logic in main.py is backend-agnostic. The database is opened in WAL
+mode with synchronous=NORMAL (FULL in strict durability mode), and entity
+text is mirrored into an FTS5 table for indexed full-text search.
+"""
+
+from pathlib import Path
+import orjson
+import sqlite3
+import threading
+
+_conn = None
+_lock = threading.Lock()
+_fts_trigram = False
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    name TEXT PRIMARY KEY,
+    entityType TEXT NOT NULL,
+    observations_json TEXT NOT NULL DEFAULT '[]',
+    created_at TEXT,
+    updated_at TEXT,
+    source TEXT,
+    user_id TEXT,
+    tags_json TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS relations (
+    from_name TEXT NOT NULL,
+    to_name TEXT NOT NULL,
+    relationType TEXT NOT NULL,
+    PRIMARY KEY (from_name, to_name, relationType)
+);
+CREATE INDEX IF NOT EXISTS relations_to ON relations (to_name);
+"""
+
+
+def _create_fts_table(conn: sqlite3.Connection) -> bool:
+    """Create the entities_fts table; returns True if trigram tokenization is used."""
+    try:
+        # trigram tokenizer (SQLite >= 3.34) gives case-insensitive substring
+        # semantics matching the in-memory search path.
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS entities_fts"
+            " USING fts5(name, entityType, observations, tokenize='trigram')"
+        )
+        return True
+    except sqlite3.OperationalError:
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS entities_fts"
+            " USING fts5(name, entityType, observations)"
+        )
+        return False
+
+
+def _fts_search(conn: sqlite3.Connection, trigram: bool, query: str):
+    """Entity names matching query via FTS5, or None if FTS cannot answer."""
+    if trigram and len(query) < 3:
+        return None
+    match = '"%s"' % query.replace('"', '""')
+    try:
+        rows = conn.execute(
+            "SELECT name FROM entities_fts WHERE entities_fts MATCH ?", (match,)
+        ).fetchall()
+    except sqlite3.OperationalError:
+        return None
+    return [name for (name,) in rows]
+
+
+def init(path: Path, strict: bool = False):
+    """Open (or create) the database and make sure the schema exists."""
+    global _conn, _fts_trigram
+    _conn = sqlite3.connect(str(path), check_same_thread=False)
+    _conn.execute("PRAGMA journal_mode=WAL")
+    _conn.execute("PRAGMA synchronous=%s" % ("FULL" if strict else "NORMAL"))
+    _conn.executescript(_SCHEMA)
+    _fts_trigram = _create_fts_table(_conn)
+    _conn.commit()
+
+
+def load_graph() -> tuple:
+    """Return (entity dicts, relation dicts) for the whole database."""
+    with _lock:
+        entity_rows = _conn.execute(
+            "SELECT name, entityType, observations_json, created_at, updated_at,"
+            " source, user_id, tags_json FROM entities"
+        ).fetchall()
+        relation_rows = _conn.execute(
+            "SELECT from_name, to_name, relationType FROM relations"
+        ).fetchall()
+    entities = [
+        {
+            "name": name,
+            "entityType": entity_type,
+            "observations": orjson.loads(observations_json),
+            "created_at": created_at,
+            "updated_at": updated_at,
+            "source": source,
+            "user_id": user_id,
+            "tags": orjson.loads(tags_json),
+        }
+        for name, entity_type, observations_json, created_at, updated_at,
+            source, user_id, tags_json in entity_rows
+    ]
+    relations = [
+        {"from": from_name, "to": to_name, "relationType": relation_type}
+        for from_name, to_name, relation_type in relation_rows
+    ]
+    return entities, relations
+
+
+def _refresh_fts(name: str):
+    row = _conn.execute(
+        "SELECT entityType, observations_json FROM entities WHERE name = ?", (name,)
+    ).fetchone()
+    _conn.execute("DELETE FROM entities_fts WHERE name = ?", (name,))
+    if row is not None:
+        entity_type, observations_json = row
+        _conn.execute(
+            "INSERT INTO entities_fts (name, entityType, observations) VALUES (?, ?, ?)",
+            (name, entity_type, "\n".join(orjson.loads(observations_json))),
+        )
+
+
+def apply_records(records: list):
+    """Apply one commit batch of log records inside a single transaction."""
+    with _lock, _conn:
+        for record in records:
+            kind = record["type"]
+            if kind == "entity":
+                cur = _conn.execute(
+                    "INSERT OR IGNORE INTO entities"
+                    " (name, entityType, observations_json, created_at, updated_at,"
+                    "  source, user_id, tags_json) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        record["name"],
+                        record["entityType"],
+                        orjson.dumps(record.get("observations") or []).decode(),
+                        record.get("created_at"),
+                        record.get("updated_at"),
+                        record.get("source"),
+                        record.get("user_id"),
+                        orjson.dumps(record.get("tags") or []).decode(),
+                    ),
+                )
+                if cur.rowcount:
+                    _refresh_fts(record["name"])
+            elif kind == "relation":
+                _conn.execute(
+                    "INSERT OR IGNORE INTO relations (from_name, to_name, relationType)"
+                    " VALUES (?, ?, ?)",
+                    (record["from"], record["to"], record["relationType"]),
+                )
+            elif kind == "observation":
+                row = _conn.execute(
+                    "SELECT observations_json FROM entities WHERE name = ?",
+                    (record["entityName"],),
+                ).fetchone()
+                if row is None:
+                    continue
+                observations = orjson.loads(row[0])
+                seen = set(observations)
+                observations.extend(c for c in record["contents"] if c not in seen)
+                _conn.execute(
+                    "UPDATE entities SET observations_json = ?, updated_at = ? WHERE name = ?",
+                    (orjson.dumps(observations).decode(), record.get("updated_at"), record["entityName"]),
+                )
+                _refresh_fts(record["entityName"])
+            elif kind == "tombstone_entity":
+                _conn.execute("DELETE FROM entities WHERE name = ?", (record["name"],))
+                _conn.execute(
+                    "DELETE FROM relations WHERE from_name = ? OR to_name = ?",
+                    (record["name"], record["name"]),
+                )
+                _conn.execute("DELETE FROM entities_fts WHERE name = ?", (record["name"],))
+            elif kind == "tombstone_relation":
+                _conn.execute(
+                    "DELETE FROM relations WHERE from_name = ? AND to_name = ? AND relationType = ?",
+                    (record["from"], record["to"], record["relationType"]),
+                )
+            elif kind == "tombstone_observations":
+                row = _conn.execute(
+                    "SELECT observations_json FROM entities WHERE name = ?",
+                    (record["entityName"],),
+                ).fetchone()
+                if row is None:
+                    continue
+                remove = set(record["observations"])
+                observations = [o for o in orjson.loads(row[0]) if o not in remove]
+                _conn.execute(
+                    "UPDATE entities SET observations_json = ?, updated_at = ? WHERE name = ?",
+                    (orjson.dumps(observations).decode(), record.get("updated_at"), record["entityName"]),
+                )
+                _refresh_fts(record["entityName"])
+
+
+def search_names(query: str):
+    """Entity names matching the query via FTS5, or None if FTS cannot answer.
+
+    With the trigram tokenizer queries shorter than three characters cannot
+    be served; callers fall back to the in-memory scan in that case.
+    """
+    with _lock:
+        return _fts_search(_conn, _fts_trigram, query)
+
+
+class FtsIndex:
+    """Persistent FTS5 sidecar indexing entity text for the JSONL backend.
+
+    The JSONL log remains the system of record; the sidecar is updated as
+    commits land and carries a stamp of the log's (mtime, size) so a stale
+    index -- e.g. after the log was modified by another process -- is
+    detected and rebuilt lazily on the next search.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._trigram = _create_fts_table(self._conn)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT)")
+        self._conn.commit()
+
+    def stamp(self):
+        with self._lock:
+            row = self._conn.execute("SELECT v FROM meta WHERE k = 'log_stamp'").fetchone()
+        return row[0] if row else None
+
+    def set_stamp(self, value: str):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('log_stamp', ?)", (value,))
+
+    def rebuild(self, entities: list, stamp: str):
+        """Re-index (name, entityType, observations) rows from scratch."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entities_fts")
+            self._conn.executemany(
+                "INSERT INTO entities_fts (name, entityType, observations) VALUES (?, ?, ?)",
+                [(name, entity_type, "\n".join(observations)) for name, entity_type, observations in entities],
+            )
+            self._conn.execute("INSERT OR REPLACE INTO meta (k, v) VALUES ('log_stamp', ?)", (stamp,))
+
+    def update(self, name: str, entity_type: str, observations: list):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entities_fts WHERE name = ?", (name,))
+            self._conn.execute(
+                "INSERT INTO entities_fts (name, entityType, observations) VALUES (?, ?, ?)",
+                (name, entity_type, "\n".join(observations)),
+            )
+
+    def delete(self, name: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entities_fts WHERE name = ?", (name,))
+
+    def search(self, query: str):
+        with self._lock:
+            return _fts_search(self._conn, self._trigram, query)